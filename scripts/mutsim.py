@@ -35,8 +35,9 @@ def main():
   # print program name
   timeadapt.print_info(sys.argv[0],options["verbose"],batch=options["batch"],sim=options["sim"])
 
-  # set random seed:
-  np.random.seed(options["seed_mut"])
+  # set random seed: independent streams for mutations (msprime) and sequencing (timeadapt)
+  mutation_seed_seq, sequencing_seed_seq = np.random.SeedSequence(options["seed_mut"]).spawn(2)
+  timeadapt.seed_rng(sequencing_seed_seq)
 
   # read sample and genome info file
   #sample = timeadapt.read_sample_info(sample_info_file=options["sample_file"])
@@ -87,7 +88,7 @@ def main():
   treesq = pyslim.load("results/"+options["project"]+"/"+options["batch"]+"/forwsim_"+options["sim"]+".trees")
 
   # Simulate neutral mutation over the tree sequence
-  msprime_seed = np.random.randint(1, 2**32-1)
+  msprime_seed = int(np.random.default_rng(mutation_seed_seq).integers(1, 2**32-1))
   if options["verbose"]>=10 : print("SEED: " + str(msprime_seed) )
   mut_treesq = msprime.sim_mutations(treesq,
                                      rate = options["mu"],
@@ -14,16 +14,22 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #
-import configparser  # for reading ini files
+import os
+import copy
+from functools import lru_cache, wraps
 import pandas as pd  # for reading "table" files 
 import numpy as np
 import scipy.stats as st
-import random
 import allel
 import math
-import tempfile # for creating temporal files on testing
 import pytest
 
+# recombination rate between chromosomes (for msprime rate maps)
+_LOG2 = math.log(2.0)
+
+# random number generator of the module: sequencing, parameter trajectories and sample ages (see seed_rng())
+_rng = np.random.default_rng()
+
 ### PRINT INFO ######################################################################################
 def print_info(script_name,verbose,project=None,batch=None,sim=None):
   if verbose >=1 :
@@ -45,36 +51,83 @@ def print_info(script_name,verbose,project=None,batch=None,sim=None):
     print("miguel.navascues@inrae.fr")
     print("#########################################")
 
+### CACHE FILE READING ###################################################################################
+def _cached_by_mtime(read_file):
+  # results of read_file(file) are cached by file path and modification time (a modified file is
+  # read again); each call returns a deep copy, so callers cannot modify the cached results
+  cached_read = lru_cache(maxsize=8)(lambda file, mtime: read_file(file))
+  @wraps(read_file)
+  def read(*args, **kwargs):
+    file, = args + tuple(kwargs.values()) # the file path, passed by position or by name
+    return copy.deepcopy(cached_read(file, os.path.getmtime(file)))
+  read.cache_clear = cached_read.cache_clear
+  return read
+
+### READ INI FILE ###################################################################################
+class _IniSection(dict):
+  # option names are case-insensitive (as in configparser)
+  def __setitem__(self, key, value):
+    super().__setitem__(key.lower(), value)
+  def __getitem__(self, key):
+    return super().__getitem__(key.lower())
+  def __contains__(self, key):
+    return super().__contains__(key.lower())
+
+@_cached_by_mtime
+def _load_ini(ini_file):
+  # ini files of the project are flat "key=value" lists (no interpolation, no multiline values)
+  ini = {}
+  section = None
+  with open(ini_file) as f:
+    for line_number, line in enumerate(f, start=1):
+      line = line.strip()
+      if not line or line[0] in ';#':
+        continue
+      if line[0] == '[' and line[-1] == ']':
+        section = ini.setdefault(line[1:-1], _IniSection())
+        continue
+      key, sep, value = line.partition('=')
+      if not sep or section is None:
+        msg = "Cannot parse line " + str(line_number) + " of " + ini_file + \
+              " (expected '[section]' or 'key=value' after a section): " + line
+        raise ValueError(msg)
+      section[key.strip()] = value.strip()
+  return ini
+
+### SET RANDOM SEED ###################################################################################
+def seed_rng(seed):
+  global _rng
+  _rng = np.random.default_rng(seed)
+
 ### GET PROJECT OPTIONS ###############################################################################
 def get_project_options(proj_options_file):
-  proj_options = configparser.ConfigParser()
-  proj_options.read(proj_options_file)
+  proj_options = _load_ini(proj_options_file)
   # Settings
   assert 'Settings' in proj_options,"Missing [Settings] section in file"
   assert 'project' in proj_options['Settings'],"Missing 'project' parameter in file"
-  project        = proj_options.get('Settings','project')
+  project        = proj_options['Settings']['project']
   try:
-    verbose      = proj_options.getint('Settings','verbose')
-  except:
-    verbose      = int(proj_options.getfloat('Settings','verbose'))
+    verbose      = int(proj_options['Settings']['verbose'])
+  except ValueError:
+    verbose      = int(float(proj_options['Settings']['verbose']))
     #project_dir    = proj_options.get('Settings','project_dir')
   # Model
   assert 'Model' in proj_options,"Missing [Model] section in project options file"
-  periods_coalescence  = proj_options.getint('Model','periods_coalescence')
-  times_of_change_back = [int(i) for i in proj_options.get("Model","times_of_change_back").split()]
+  periods_coalescence  = int(proj_options['Model']['periods_coalescence'])
+  times_of_change_back = [int(i) for i in proj_options['Model']['times_of_change_back'].split()]
   # Sample
   assert 'Sample' in proj_options,"Missing [Model] section in project options file"
-  total_sample_size = proj_options.getint('Sample','size')
-  coverage     = [float(i)    for i in proj_options.get("Sample","coverage").split()]  
-  is_damaged   = [(i=="TRUE") for i in proj_options.get("Sample","is_damaged").split()]
-  group_levels = proj_options.getint('Sample','group_levels')
-  groups       = [i for i in proj_options.get("Sample","groups").split()]  
+  total_sample_size = int(proj_options['Sample']['size'])
+  coverage     = [float(i)    for i in proj_options['Sample']['coverage'].split()]  
+  is_damaged   = [(i=="TRUE") for i in proj_options['Sample']['is_damaged'].split()]
+  group_levels = int(proj_options['Sample']['group_levels'])
+  groups       = [i for i in proj_options['Sample']['groups'].split()]  
   # Genome
   assert 'Genome' in proj_options,"Missing [Model] section in project options file"
-  nchr = proj_options.getint('Genome','nchr')
-  chr_ends = [int(i) for i in proj_options.get("Genome","chr_ends").split()]
-  msprime_r_map_positions  = [int(i) for i in proj_options.get("Genome","msprime_r_map_positions").split()]
-  msprime_r_map_rates = [float(i) for i in proj_options.get("Genome","msprime_r_map_rates").split()]
+  nchr = int(proj_options['Genome']['nchr'])
+  chr_ends = [int(i) for i in proj_options['Genome']['chr_ends'].split()]
+  msprime_r_map_positions  = [int(i) for i in proj_options['Genome']['msprime_r_map_positions'].split()]
+  msprime_r_map_rates = [float(i) for i in proj_options['Genome']['msprime_r_map_rates'].split()]
   # TODO
   return {"project" : project,
           "verbose" : verbose,
@@ -118,22 +171,20 @@ def get_times_of_change(total_length,number_of_periods,mode="regular",exponent=2
 
 ### GET SIM OPTIONS ######################################################################################
 def get_sim_options(sim_options_file):
-  sim_options = configparser.ConfigParser()
-  sim_options.read(sim_options_file)
-  sim          = sim_options.get('Simulation', 'sim')
-  batch        = sim_options.get('Simulation', 'batch')
-  ss           = [int(i)   for i in sim_options.get("Sample", "ss").split()]
-  chrono_order = [int(i)   for i in sim_options.get("Sample", "chrono_order").split()]
+  sim_options = _load_ini(sim_options_file)
+  sim          = sim_options['Simulation']['sim']
+  batch        = sim_options['Simulation']['batch']
+  ss           = np.array(sim_options['Sample']['ss'].split(), dtype=np.int64)
+  chrono_order = np.array(sim_options['Sample']['chrono_order'].split(), dtype=np.int64)
   assert sum(ss)==len(chrono_order), "Verify number of samples, inconsistent sample size across simulation options file"
-  N            = [int(i) for i in sim_options.get("Demography","N").split()]
-  for i in N:
-    assert i>0, "Verify population sizes, they can be only positive values (excluding zero)"
-  mu           = sim_options.getfloat('Genome','mu')
+  N            = np.array(sim_options['Demography']['N'].split(), dtype=np.int64)
+  assert np.all(N>0), "Verify population sizes, they can be only positive values (excluding zero)"
+  mu           = float(sim_options['Genome']['mu'])
   assert mu>=0, "Verify mutation rate, it can be only positive values and zero"
-  ttratio      = sim_options.getfloat('Genome','ttratio')
-  seq_error    = sim_options.getfloat('Genome','seq_error')
-  seed_coal    = sim_options.getint('Seeds','seed_coal')
-  seed_mut     = sim_options.getint('Seeds','seed_mut')
+  ttratio      = float(sim_options['Genome']['ttratio'])
+  seq_error    = float(sim_options['Genome']['seq_error'])
+  seed_coal    = int(sim_options['Seeds']['seed_coal'])
+  seed_mut     = int(sim_options['Seeds']['seed_mut'])
   return {"sim":sim,
           "batch":batch,
           "ss":ss, 
@@ -152,89 +203,75 @@ def get_options(proj_options_file,sim_options_file):
   return options
 
 ### READ SAMPLE INFO ######################################################################################
+@_cached_by_mtime
 def read_sample_info(sample_info_file):
   # TODO : make it work with only ancient data (i.e. no year column) or no ancient data (no age14C)
-  info = pd.read_table(filepath_or_buffer=sample_info_file, sep=r'\s+',
-                       converters={'groups': lambda x: str(x)})
+  info = pd.read_csv(filepath_or_buffer=sample_info_file, sep=r'\s+', engine='c',
+                     dtype={'groups': str})
   # check header of file
   header = set(info.columns.values)
   expected_header = set(["sampleID","age14C","age14Cerror","year","coverage","damageRepair","groups"])
   assert header==expected_header, "Sample file does not have the expected column names"
   
   sample_size = len(info)
-  group_levels = len(info["groups"][1])
-  groups = np.full((group_levels, sample_size), 0, "int")
-  is_ancient = []
-  is_modern = []
-  total_ancient = 0
-  for i, row in info.iterrows():
-      if len(row["groups"]) != group_levels:
-          print("Error: verify that all individuals are assigned to groups")
-          # TODO : interrupt program here
-      if np.isnan(row["year"]):
-          is_ancient.append(True)
-          is_modern.append(False)
-          total_ancient = total_ancient + 1
-      else:
-          is_ancient.append(False)
-          is_modern.append(True)
-      for level in range(0, group_levels):
-          groups[level, i] = row["groups"][level]
+  assert info["groups"].str.len().nunique()==1, "Verify that all individuals are assigned to groups"
+  assert info["groups"].str.isdigit().all(), "Verify that groups are coded with digits (one per group level)"
+  group_levels = len(info["groups"][0])
+  # one digit per group level: decode the characters of the "groups" strings as unicode code points
+  groups = np.array(info["groups"].tolist(), dtype="U"+str(group_levels))
+  groups = (groups.view(np.uint32).reshape(sample_size, group_levels) - ord('0')).T.astype(np.int8)
+  is_ancient = info["year"].isna().to_numpy()
+  is_modern = ~is_ancient
+  total_ancient = int(is_ancient.sum())
   t0 = info["year"].max()
 
-  return {"id":info["sampleID"],
-          "age14C":info["age14C"],
-          "age14Cerror":info["age14Cerror"],
-          "ageBCAD":info["year"],
+  return {"id":np.asarray(info["sampleID"]),
+          "age14C":np.asarray(info["age14C"]),
+          "age14Cerror":np.asarray(info["age14Cerror"]),
+          "ageBCAD":np.asarray(info["year"]),
           "t0":info["year"].max(skipna=True),
-          "coverage":info["coverage"],
+          "coverage":np.asarray(info["coverage"]),
           "is_ancient":is_ancient, 
           "is_modern":is_modern,
-          "is_dr":info["damageRepair"], 
+          "is_dr":np.asarray(info["damageRepair"]), 
           "total_ancient":total_ancient,
           "size":sample_size,
           "group_levels":group_levels, 
           "groups":groups}
 
 ### READ GENOME INFO ######################################################################################
+@_cached_by_mtime
 def get_genome_info(genome_info_file):
-  table = pd.read_table(filepath_or_buffer=genome_info_file, sep=r'\s+')
+  table = pd.read_csv(filepath_or_buffer=genome_info_file, sep=r'\s+', engine='c')
   # check header of file
   header = set(table.columns.values)
   expected_header = set(["Chromosome","Position","Recombination_rate"])
   assert header==expected_header, "Genome file does not have the expected column names"
 
   nchr = max(table["Chromosome"])
-  chromosomes = list(table["Chromosome"])
-  rates = list(table["Recombination_rate"])
-  positions = list(table["Position"])
-  chr_ends_index = list(np.append(np.where(np.diff(chromosomes)==1)[0],len(chromosomes)-1))
-  chr_ends = list(map(positions.__getitem__,chr_ends_index))
-  rescaling_values = np.append(0,np.cumsum(chr_ends))
-  chromo = 0
+  chromosomes = table["Chromosome"].to_numpy()
+  rates = table["Recombination_rate"].to_numpy(dtype=float)
+  positions = table["Position"].to_numpy(dtype=np.int64)
+  # last row of each chromosome (chr_boundaries excludes the last chromosome)
+  chr_boundaries = np.flatnonzero(np.diff(chromosomes))
+  chr_ends_index = np.append(chr_boundaries, len(chromosomes)-1)
   # sum lenght of previous chromosomes to positions
-  for i in range(0,len(positions)):
-    positions[i] = positions[i] + rescaling_values[chromo]
-    if (i in chr_ends_index):
-      chromo += 1
-  chr_ends = list(map(positions.__getitem__,chr_ends_index))
-  L=chr_ends[-1]-1
+  rescaling_values = np.append(0, np.cumsum(positions[chr_ends_index])[:-1])
+  positions = positions + np.repeat(rescaling_values, np.diff(np.append(-1, chr_ends_index)))
+  chr_ends = positions[chr_ends_index]
+  L = chr_ends[-1]-1
   # insert recombination rate between chromosomes
-  slim_rates = rates[:]
-  for chromo in range(0,nchr-1):
-    positions.insert(chr_ends_index[chromo]+1+chromo,positions[chr_ends_index[chromo]+chromo]+1)
-    rates.insert(chr_ends_index[chromo]+1+chromo,math.log(2))
-    slim_rates.insert(chr_ends_index[chromo]+1+chromo,0.5)
-  slim_positions = [int(x-1) for x in positions]
-  positions = [int(x) for x in positions]
-  chr_ends = [int(x) for x in chr_ends] 
-  positions.insert(0,0) # insert first position
-
-  return {"nchr":nchr,
-          "chr_ends":chr_ends,
+  slim_rates = np.insert(rates, chr_boundaries+1, 0.5)
+  rates = np.insert(rates, chr_boundaries+1, _LOG2)
+  positions = np.insert(positions, chr_boundaries+1, positions[chr_boundaries]+1)
+  slim_positions = positions-1
+  positions = np.append(0, positions) # insert first position
+
+  return {"nchr":int(nchr),
+          "chr_ends":chr_ends.tolist(),
           "L":int(L),
-          "msprime_r_map":{"rates":rates, "positions":positions},
-          "slim_r_map":{"rates":slim_rates, "positions":slim_positions}}
+          "msprime_r_map":{"rates":rates.tolist(), "positions":positions.tolist()},
+          "slim_r_map":{"rates":slim_rates.tolist(), "positions":slim_positions.tolist()}}
 
 
 ### GET SAMPLE AGES ######################################################################################
@@ -244,20 +281,23 @@ def get_sample_ages(sample,age_pdf,gen_len):
   for i in range(0,sample["size"]):
     if sample["is_modern"][i]: sample_ages[i] = sample["ageBCAD"][i]
     if sample["is_ancient"][i]:
-      sample_ages[i] = random.choices(age_pdf[ancient_counter]["ageBCAD"],
-                                      weights = age_pdf[ancient_counter]["PrDens"])
-      
+      weights = np.asarray(age_pdf[ancient_counter]["PrDens"], dtype=float)
+      sample_ages[i] = _rng.choice(np.asarray(age_pdf[ancient_counter]["ageBCAD"]),
+                                   p = weights/weights.sum())
       ancient_counter += 1
     sample_ages[i] = int(abs(sample_ages[i]-sample["t0"])/gen_len)
   return sample_ages
 
 ### SAMPLE PARAMETER TRAJECTORY #######################################################################
 def sample_param_trajectory(times,minimum,maximum,factor=10):
+  # log-uniform values for the initial value and the change factors, drawn at once
+  log_draws = _rng.uniform(low=-math.log(factor), high=math.log(factor), size=times)
+  log_draws[0] = _rng.uniform(low=math.log(minimum), high=math.log(maximum))
+  steps = np.exp(log_draws)
   trajectory = np.zeros(shape=times)
-  trajectory[0] = st.loguniform.rvs(a=minimum, b=maximum, size=1)
+  trajectory[0] = steps[0]
   for i in range(1,times):
-    trajectory[i] = trajectory[i-1] * st.loguniform.rvs(a=1/factor, b=1*factor, size=1)
-    trajectory[i] = max( min(trajectory[i],maximum) , minimum )
+    trajectory[i] = max( min(trajectory[i-1] * steps[i], maximum) , minimum )
   return trajectory  
 
 
@@ -296,7 +336,7 @@ def empty_genotype_array(n_loci, n_samples, ploidy=2, allele=-1):
 
   :return: empty_ga
   """
-  empty_ga = allel.GenotypeArray(np.full((n_loci, n_samples, ploidy), allele, dtype='i1'), dtype='i1')
+  empty_ga = allel.GenotypeArray(np.full((n_loci, n_samples, ploidy), allele, dtype=np.int8))
   return empty_ga
 def test_empty_genotype_array():
   test_ga = empty_genotype_array(3, 4, ploidy=2, allele=-1)
@@ -309,6 +349,13 @@ def test_empty_genotype_array():
 ### end MAKE EMPTY GENOTYPE ARRAY ····························································
 
 ### SNP CALLING FROM SIMULATED READS (WITH SEQUENCING ERROR)  ····························
+# genotype calls returned by snp_calling (shared, read-only)
+_MISSING = (-1, -1)
+_HOM_ANCESTRAL = (0, 0)
+_HOM_DERIVED = (1, 1)
+_HET_01 = (0, 1)
+_HET_10 = (1, 0)
+
 def snp_calling(true_genotype, f_num_reads, error_rate=0.005, reads_th=8, score_th=5, ratio_th=10, damage=False, transversion=True):
     """
     snp_calling function takes perfect simulated data from one locus of one 
@@ -329,134 +376,141 @@ def snp_calling(true_genotype, f_num_reads, error_rate=0.005, reads_th=8, score_
     :return:
     """
     if damage is True and transversion is False:
-        genotype_call = [-1, -1]
+        genotype_call = _MISSING
     elif f_num_reads >= reads_th:
         derived_count = sum(true_genotype)
         p_derived = derived_count / 2. * (1 - error_rate) + (1 - derived_count / 2.) * error_rate
-        derived_reads = st.binom.rvs(f_num_reads, p_derived)
+        derived_reads = _rng.binomial(f_num_reads, p_derived)
         ancestral_reads = f_num_reads - derived_reads
         if f_num_reads >= (score_th*2):
             if derived_reads == 0:
-                genotype_call = [0, 0]
+                genotype_call = _HOM_ANCESTRAL
             elif ancestral_reads == 0:
-                genotype_call = [1, 1]
+                genotype_call = _HOM_DERIVED
             else:
                 if (derived_reads >= score_th) & (ancestral_reads < score_th):
-                  genotype_call = [1, 1]
+                  genotype_call = _HOM_DERIVED
                 elif (derived_reads < score_th) & (ancestral_reads >= score_th):
-                  genotype_call = [0, 0]
+                  genotype_call = _HOM_ANCESTRAL
                 elif (derived_reads >= score_th) & (ancestral_reads >= score_th):
                   ratio_of_scores = derived_reads / ancestral_reads
                   if (ratio_of_scores >= 1 / ratio_th) & (ratio_of_scores <= ratio_th):
                     if (derived_count == 1):
                       genotype_call = true_genotype
-                    elif (st.binom.rvs(1, 0.5) == 1):
-                      genotype_call = [0, 1]
+                    elif (_rng.binomial(1, 0.5) == 1):
+                      genotype_call = _HET_01
                     else:
-                      genotype_call = [1, 0]
+                      genotype_call = _HET_10
                   elif derived_reads > ancestral_reads:
-                    genotype_call = [1, 1]
+                    genotype_call = _HOM_DERIVED
                   else:
-                    genotype_call = [0, 0]
+                    genotype_call = _HOM_ANCESTRAL
+        else:
+            genotype_call = _MISSING
     else:
-        genotype_call = [-1, -1]
+        genotype_call = _MISSING
     return genotype_call
 def test_snp_calling():
-  np.random.seed(1234)
+  seed_rng(1234)
   genotype_call = snp_calling( [0, 1], 100, error_rate=0.005, reads_th=1,
                 score_th=10, ratio_th=3, damage=False, transversion=True)
-  assert genotype_call == [0,1]
+  assert list(genotype_call) == [0,1]
   genotype_call = snp_calling( [0, 1], 1, error_rate=0.005, reads_th=10,
                 score_th=10, ratio_th=3, damage=False, transversion=True)
-  assert genotype_call == [-1,-1]
+  assert list(genotype_call) == [-1,-1]
 ### end SNP CALLING FROM SIMULATED READS (WITH SEQUENCING ERROR)  ····························
 
+### SNP CALLING FROM SIMULATED READS : ALL LOCI AND INDIVIDUALS  ····························
+def snp_calling_batch(genotypes, num_reads, damage, transversion, error_rate=0.005, reads_th=8, score_th=5, ratio_th=10):
+    """
+    snp_calling_batch function does the same as snp_calling for all loci and
+    all diploid individuals at once. Calls are only made when there are enough
+    reads to apply score_th to both alleles (i.e. at least 2*score_th reads),
+    otherwise the genotype is missing data.
+
+    :param genotypes: haplotypes (n_loci, 2*n_samples), as from ts.genotype_matrix()
+    :param num_reads: number of reads (n_loci, n_samples)
+    :param damage: (n_samples) True for ancient DNA not from damage repair libraries
+    :param transversion: (n_loci) True for transversion SNPs
+    :param error_rate:
+    :param reads_th:
+    :param score_th:
+    :param ratio_th:
+    :return: genotype calls (n_loci, n_samples, 2) as int8
+    """
+    genotypes = np.asarray(genotypes, dtype=np.int8)
+    num_reads = np.asarray(num_reads)
+    first = genotypes[:, 0::2]
+    second = genotypes[:, 1::2]
+    derived_count = first + second
+    # probability of a read with the derived allele, looked up by number of derived alleles (0, 1 or 2)
+    p_derived = np.arange(3) / 2. * (1 - error_rate) + (1 - np.arange(3) / 2.) * error_rate
+    is_called = (num_reads >= reads_th) & (num_reads >= score_th*2)
+    is_called &= ~(np.asarray(damage)[np.newaxis, :] & ~np.reshape(transversion, (-1, 1)))
+    # reads are only drawn for genotypes that can be called, the others are missing data
+    derived_reads = np.zeros(num_reads.shape, dtype=np.int64)
+    derived_reads[is_called] = _rng.binomial(num_reads[is_called], p_derived[derived_count[is_called]])
+    ancestral_reads = num_reads - derived_reads
+    is_het = (derived_reads >= score_th) & (ancestral_reads >= score_th)
+    is_het &= derived_reads * ratio_th >= ancestral_reads
+    is_het &= derived_reads <= ancestral_reads * ratio_th
+    # call codes: -1 missing, 0 homozygous ancestral, 1 heterozygous, 2 homozygous derived;
+    # if not heterozygous, the allele with more reads is called (with at least 2*score_th reads,
+    # it is the only one reaching score_th if the other does not)
+    call = np.select([~is_called, is_het, derived_reads > ancestral_reads],
+                     [np.int8(-1), np.int8(1), np.int8(2)], default=np.int8(0))
+    # genotypes by call code (code -1 takes the last row), heterozygous phase is set below
+    genotype_of_call = np.array([[0, 0], [0, 1], [1, 1], [-1, -1]], dtype=np.int8)
+    genotype_calls = genotype_of_call[call]
+    is_het = call == 1
+    # heterozygous calls keep the phase of true heterozygous, otherwise phase is random
+    is_true_het = is_het & (derived_count == 1)
+    genotype_calls[is_true_het, 0] = first[is_true_het]
+    genotype_calls[is_true_het, 1] = second[is_true_het]
+    is_false_het = is_het & (derived_count != 1)
+    random_phase = _rng.binomial(1, 0.5, size=np.count_nonzero(is_false_het))
+    genotype_calls[is_false_het, 0] = 1 - random_phase
+    genotype_calls[is_false_het, 1] = random_phase
+    return genotype_calls
+### end SNP CALLING FROM SIMULATED READS : ALL LOCI AND INDIVIDUALS  ····························
+
 ### SIMULATE SEQUENCING  ····························
-def sequencing(ts, ssize, ttr, seq_error, damage, cov):
+def sequencing(ts, ssize, ttr, seq_error, damage, cov, block_size=100000):
   if len(cov) != ssize:
     msg = "Number of coverage values (length=" + str(len(cov)) + \
           ") and number of samples (ssize=" + str(ssize) + \
           ") do not match"
     raise ValueError(msg)
 
-  geno_data = empty_genotype_array(n_loci=ts.num_sites,
-                                   n_samples=ssize,
-                                   ploidy=2)
-  positions = []
-  locus = 0
-  for variant in ts.variants():
-    positions.append(round(variant.position))
-    #print(variant.position)
-    var_genotypes = variant.genotypes
-    # print("--------------------------------")
-    # print(var_genotypes)
-    num_reads = np.random.poisson(lam=cov, size=ssize)
-    transversion_snp = True
-    if np.random.random() < ttr / (ttr + 1):
-      transversion_snp = False
-    # print(num_reads)
-    for i in range(0, 2 * ssize, 2):
-      if len(variant.alleles)==2:
-        genotype_call = snp_calling(true_genotype=var_genotypes[i:(i + 2)],
-                                                  f_num_reads=num_reads[int(i / 2)],
-                                                  error_rate=seq_error,
-                                                  damage=damage[int(i / 2)],
-                                                  transversion=transversion_snp)
-      else:
-        genotype_call = [-1, -1] # this removes all SNP with more than two alleles
-      geno_data[locus, int(i / 2)] = genotype_call
-    locus = locus + 1
-    #print(locus)
-  return geno_data, positions
-#def test_sequencing():
-  # np.random.seed(1234)
-  # TODO create a ts and some test from it
+  # only the site and mutation columns are read (ts.tables would copy all tables)
+  positions = np.round(ts.sites_position).astype(np.int64)
+  # number of alleles (as len(variant.alleles)) only needs to be checked at sites with
+  # more than one mutation (mutation models of msprime do not produce silent mutations)
+  num_of_mutations = np.bincount(ts.mutations_site, minlength=ts.num_sites)
+  biallelic = num_of_mutations == 1
+  for site_id in np.flatnonzero(num_of_mutations > 1):
+    site = ts.site(site_id)
+    alleles = set([site.ancestral_state] + [mutation.derived_state for mutation in site.mutations])
+    biallelic[site_id] = len(alleles)==2
+  snp_ids = np.flatnonzero(biallelic)
+  # genotypes are decoded at once (in C) for the first 2*ssize sample nodes only
+  genotype_matrix = ts.genotype_matrix(samples=ts.samples()[:2*ssize])
+  # SNP with more than two alleles are left as missing data
+  geno_data = np.full((ts.num_sites, ssize, 2), -1, dtype=np.int8)
+  # reads, transversion status and SNP calls are done at once for blocks of biallelic sites,
+  # which bounds the size of the temporary arrays of snp_calling_batch for long genomes
+  for block_start in range(0, len(snp_ids), block_size):
+    block = snp_ids[block_start:block_start+block_size]
+    num_reads = _rng.poisson(lam=cov, size=(len(block), ssize))
+    transversion_snp = _rng.random(len(block)) >= ttr / (ttr + 1)
+    geno_data[block] = snp_calling_batch(genotypes=genotype_matrix[block],
+                                         num_reads=num_reads,
+                                         damage=damage,
+                                         transversion=transversion_snp,
+                                         error_rate=seq_error)
+  return allel.GenotypeArray(geno_data), positions
 ### end SIMULATE SEQUENCING  ····························
 
-### TEST DATA FOR SUMMARY STATISTISCS
-#                                  ind 0   ind 1   ind 2   ind 3  
-test_ga_A = allel.GenotypeArray([[[ 0, 0],[ 0, 0],[ 0, 0],[ 0, 0]], # locus 0
-                                 [[ 0, 1],[ 0, 1],[ 0, 1],[ 1, 1]], # locus 1
-                                 [[-1,-1],[-1,-1],[-1,-1],[-1,-1]], # locus 2
-                                 [[ 1, 1],[ 1, 1],[ 0, 1],[ 1, 1]], # locus 3
-                                 [[ 0, 1],[ 0, 0],[ 0, 1],[ 0,-1]]],# locus 4
-                                 dtype='i1')
-#              0   1   2   3   4
-test_pos_A = (10,123,234,299,340)
-#                                  ind 0   ind 1   ind 2   ind 3  
-test_ga_B = allel.GenotypeArray([[[ 0, 1],[ 0, 1],[ 1, 1],[ 0, 0]], # locus 0
-                                 [[ 0, 1],[ 0, 1],[ 0, 1],[ 1, 1]], # locus 1
-                                 [[ 0, 1],[ 0, 1],[-1,-1],[ 1, 1]], # locus 2
-                                 [[ 0, 1],[ 0, 0],[ 0, 1],[ 1, 1]], # locus 3
-                                 [[ 0, 1],[ 0, 1],[ 0, 0],[ 1, 1]], # locus 4
-                                 [[ 0, 1],[ 0, 1],[ 0, 0],[ 1, 1]], # locus 5
-                                 [[ 1, 1],[ 0, 1],[ 0, 1],[ 1, 1]], # locus 6
-                                 [[ 0, 1],[ 0, 1],[ 0, 0],[ 1, 1]], # locus 7
-                                 [[ 1, 1],[ 0, 1],[ 0, 0],[ 0, 1]], # locus 8
-                                 [[ 0, 1],[ 0, 1],[ 0, 0],[ 1, 1]], # locus 9
-                                 [[ 1, 1],[ 0, 1],[ 0, 1],[ 1, 1]], # locus 10
-                                 [[ 0, 1],[ 0, 1],[ 0, 0],[ 1, 1]], # locus 11
-                                 [[ 0, 0],[ 0, 1],[ 0, 1],[ 0, 1]], # locus 12
-                                 [[-1,-1],[-1,-1],[-1,-1],[ 1, 1]], # locus 13
-                                 [[ 1, 1],[ 1, 1],[ 0, 0],[ 1, 1]], # locus 14
-                                 [[ 1, 1],[ 1, 1],[ 0, 0],[ 1, 1]], # locus 15
-                                 [[ 1, 1],[ 0, 1],[ 0, 0],[ 0, 1]], # locus 16
-                                 [[ 1, 1],[ 1, 1],[ 1, 0],[ 1, 1]], # locus 17
-                                 [[ 1, 1],[ 1, 1],[ 0, 0],[ 1, 1]], # locus 18
-                                 [[ 0, 1],[ 0, 0],[ 0, 1],[-1,-1]]],# locus 19
-                                 dtype='i1')
-#             0  1  2  3  4   5   6   7   8   9  10  11  12  13  14  15  16  17  18  19
-test_pos_B = (4,10,50,77,99,123,134,150,178,201,209,234,256,270,299,311,315,340,358,378)
-
-#                                 ga,        pos, nchr, chr_ends, w_size, expected_S
-testdata_S = [pytest.param(test_ga_A, test_pos_A,    1,    [400],     50,          3, id="A"),
-              pytest.param(test_ga_B, test_pos_B,    1,    [400],     50,         19, id="B")]
-#                                 ga,        pos, nchr, chr_ends, w_size, expected_Pi
-testdata_Pi = [pytest.param(test_ga_A, test_pos_A,    1,    [400],     50, 0.00315476, id="A"),
-               pytest.param(test_ga_B, test_pos_B,    1,    [400],     50, 0.02418452, id="B")]
-#                                 ga,        pos, nchr, chr_ends, w_size,  expected_WT
-testdata_WT = [pytest.param(test_ga_A, test_pos_A,    1,    [400],     50, 0.00289256, id="A"),
-               pytest.param(test_ga_B, test_pos_B,    1,    [400],     50, 0.01831956, id="B")]
 
 
 
@@ -474,9 +528,72 @@ def save_moments_2_dict(moments,sumstats,sample_name,sep,stat_name):
   sumstats[sample_name+sep+"k"+stat_name] = float(np.ma.getdata(moments[5]))
 ### end SAVE RESULTS from st.describe() INTO DICT  ····························
 
+### CALCULATE SUMMARY STATISTICS : WINDOWED DIVERSITY  ····························
+def _mean_pairwise_difference(ac):
+  # same as allel.mean_pairwise_difference(ac, fill=0), directly from allele counts
+  an = ac.sum(axis=1)
+  n_pairs = an * (an - 1)
+  n_diff = n_pairs - np.sum(ac * (ac - 1), axis=1)
+  mpd = np.zeros(len(ac))
+  np.divide(n_diff, n_pairs, out=mpd, where=n_pairs > 0)
+  return mpd
+
+def windowed_diversity_stats(pos, ac, nchr, chr_ends, w_size, mpd=None):
+  """
+  Calculates nucleotide diversity (π), Watterson θ and Tajima's D in windows
+  of size w_size along all chromosomes. Same values as allel.windowed_diversity,
+  allel.windowed_watterson_theta and allel.windowed_tajima_d, but per site
+  statistics and windows are computed once for the three statistics.
+
+  :param pos: positions of loci (1-based, increasing)
+  :param ac: allele counts (n_loci, n_alleles)
+  :param nchr: number of chromosomes
+  :param chr_ends: end position of each chromosome
+  :param w_size: size of windows
+  :param mpd: mean pairwise differences per locus, computed from ac if not given
+  :return: w_pi, w_W_theta, w_Taj_D
+  """
+  pos = np.asarray(pos)
+  ac = np.asarray(ac)
+  chr_starts = [1] + [1+chr_ends[chromo-1] for chromo in range(1,nchr)]
+  windows = np.concatenate([allel.position_windows(pos, size=w_size, start=chr_starts[chromo],
+                                                   stop=chr_ends[chromo], step=w_size)
+                            for chromo in range(0,nchr)])
+  n_bases = windows[:,1] - windows[:,0] + 1
+  # window of each locus (windows do not overlap)
+  locus_window = np.searchsorted(windows[:,0], pos, side='right') - 1
+  in_window = (locus_window >= 0) & (pos <= windows[locus_window,1])
+  locus_window = locus_window[in_window]
+  # sum of mean pairwise differences and number of segregating sites per window
+  if mpd is None: mpd = _mean_pairwise_difference(ac)
+  is_seg = np.count_nonzero(ac > 0, axis=1) > 1
+  w_mpd = np.bincount(locus_window, weights=mpd[in_window], minlength=len(windows))
+  w_S = np.bincount(locus_window, weights=is_seg[in_window], minlength=len(windows))
+  # assume number of chromosomes sampled is constant for all variants
+  n = ac.sum(axis=1).max()
+  a1 = np.sum(1 / np.arange(1, n))
+  a2 = np.sum(1 / (np.arange(1, n)**2))
+  b1 = (n + 1) / (3 * (n - 1))
+  b2 = 2 * (n**2 + n + 3) / (9 * n * (n - 1))
+  c1 = b1 - (1 / a1)
+  c2 = b2 - ((n + 2) / (a1 * n)) + (a2 / (a1**2))
+  e1 = c1 / a1
+  e2 = c2 / (a1**2 + a2)
+  w_pi = w_mpd / n_bases
+  w_W_theta = w_S / a1 / n_bases
+  with np.errstate(invalid='ignore', divide='ignore'):
+    w_Taj_D = (w_mpd - w_S / a1) / np.sqrt((e1 * w_S) + (e2 * w_S * (w_S - 1)))
+  w_Taj_D[w_S < 3] = np.nan
+  return w_pi, w_W_theta, w_Taj_D
+
+### end CALCULATE SUMMARY STATISTICS : WINDOWED DIVERSITY  ····························
+
 ### CALCULATE SUMMARY STATISTICS : SINGLE SAMPLE  ····························
 def single_sample_sumstats(ga,pos,nchr,chr_ends,w_size,sumstats,name="",sep="_",quiet=True):
-  ac = ga.count_alleles()
+  # genotypes from sequencing() are biallelic (0/1), giving max_allele avoids a pass over ga to find it
+  ac = ga.count_alleles(max_allele=1)
+  # number of alternative alleles per individual (-1 for missing), shape (variants, individuals)
+  n_alt = np.asarray(ga.to_n_alt(fill=-1))
   sfs = allel.sfs_folded(ac)
   # total number of segregating sites (excluding monomorphic and all missing data)
   segsites = sum(sfs)-sfs[0]
@@ -488,68 +605,35 @@ def single_sample_sumstats(ga,pos,nchr,chr_ends,w_size,sumstats,name="",sep="_",
   fis = st.describe(allel.inbreeding_coefficient(ga), nan_policy='omit')
   save_moments_2_dict(fis,sumstats,name,sep,"Fis")
   if quiet is False: print("Ho: " + str(ho) + "; Fis: " + str(fis) )
-  # pairwise genetic diversity
-  total_pi = allel.sequence_diversity(pos, ac, start=1, stop=chr_ends[nchr-1])
+  # pairwise genetic diversity, Watterson theta and Tajima's D in windows
+  mpd = _mean_pairwise_difference(np.asarray(ac))
+  w_pi, w_W_theta, w_Taj_D = windowed_diversity_stats(pos, ac, nchr, chr_ends, w_size, mpd=mpd)
+  # pairwise genetic diversity (as allel.sequence_diversity from 1 to the end of the last chromosome)
+  in_genome = (np.asarray(pos) >= 1) & (np.asarray(pos) <= chr_ends[nchr-1])
+  total_pi = np.sum(mpd[in_genome]) / chr_ends[nchr-1]
   sumstats[name+sep+"Pi"]=total_pi
-  w_pi, _, _, _ = allel.windowed_diversity(pos, ac, size=w_size, start= 1, stop=chr_ends[0])
-  for chromo in range(1,nchr):
-    temp, _, _, _ = allel.windowed_diversity(pos, ac, size=w_size, start= 1+chr_ends[chromo-1], stop=chr_ends[chromo])
-    np.append(w_pi,temp)
   pi = st.describe(w_pi)
   save_moments_2_dict(pi,sumstats,name,sep,"Pi")
   if quiet is False: print("π: "+ str(total_pi) + " ; " + str(pi))
   # Watterson theta (from number of segregating sites)
-  w_W_theta, _, _, _ = allel.windowed_watterson_theta(pos, ac, size=w_size, start=1, stop=chr_ends[0])
-  for chromo in range(1,nchr):
-    temp, _, _, _ = allel.windowed_watterson_theta(pos, ac, size=w_size, start=1+chr_ends[chromo-1], stop=chr_ends[chromo])
-    np.append(w_W_theta,temp)
   W_theta = st.describe(w_W_theta)
   save_moments_2_dict(W_theta,sumstats,name,sep,"WT")
   if quiet is False: print("Watterson θ: "+ str(W_theta))
   # Tajima's D
   total_Taj_D = allel.tajima_d(ac, pos, start=1, stop=chr_ends[nchr-1])
   sumstats[name+sep+"TD"]=total_Taj_D
-  w_Taj_D, _, _ = allel.windowed_tajima_d(pos, ac, size=w_size, start=1, stop=chr_ends[0])
-  for chromo in range(1,nchr):
-    temp, _, _ = allel.windowed_tajima_d(pos, ac, size=w_size, start=1+chr_ends[chromo-1], stop=chr_ends[chromo])
-    np.append(w_Taj_D,temp)
   Taj_D = st.describe(w_Taj_D, nan_policy='omit')
   save_moments_2_dict(Taj_D,sumstats,name,sep,"TD")
   if quiet is False: print("Tajima's D: "+ str(total_Taj_D)+ " ; " + str(Taj_D))
   # distribution of sizes for naive runs of homozygosity (distance between heterozygous positions)
-  roh_distribution = np.full(int(round(np.log10(w_size)))+1, 0)
-  roh_distribution = roh_distribution + windowed_distribution_roh(ga, pos, w_size, start=1, stop=chr_ends[0])
+  roh_distribution = windowed_distribution_roh(n_alt, pos, w_size, start=1, stop=chr_ends[0])
   for chromo in range(1,nchr):
-    roh_distribution + windowed_distribution_roh(ga, pos, w_size, start=1+chr_ends[chromo-1], stop=chr_ends[chromo])
+    roh_distribution += windowed_distribution_roh(n_alt, pos, w_size, start=1+chr_ends[chromo-1], stop=chr_ends[chromo])
   for i in range(0,len(roh_distribution)):
     sumstats[name+sep+"RoHD"+sep+str(i)]=roh_distribution[i]
   if quiet is False: print("Distribution of Runs of Homozygosity: "+ str(roh_distribution))
   return
 
-@pytest.mark.parametrize("ga,pos,nchr,chr_ends,w_size,expected_S", testdata_S)
-def test_single_sample_sumstats_S(ga,pos,nchr,chr_ends,w_size,expected_S):
-  test_sumstats = {}
-  single_sample_sumstats(ga, pos, nchr, chr_ends, w_size, test_sumstats)
-  assert test_sumstats["_S"] == expected_S
-  assert test_sumstats["_S"] >= 0
-
-@pytest.mark.parametrize("ga,pos,nchr,chr_ends,w_size,expected_Pi", testdata_Pi)
-def test_single_sample_sumstats_Pi(ga,pos,nchr,chr_ends,w_size,expected_Pi):
-  test_sumstats = {}
-  single_sample_sumstats(ga, pos, nchr, chr_ends, w_size, test_sumstats)
-  assert test_sumstats["_Pi"] == pytest.approx(expected_Pi)
-  assert test_sumstats["_Pi"] >= 0
-  assert test_sumstats["_mPi"] == pytest.approx(expected_Pi)
-
-@pytest.mark.parametrize("ga,pos,nchr,chr_ends,w_size,expected_WT", testdata_WT)
-def test_single_sample_sumstats_WT(ga,pos,nchr,chr_ends,w_size,expected_WT):
-  test_sumstats = {}
-  single_sample_sumstats(ga, pos, nchr, chr_ends, w_size, test_sumstats)
-  assert test_sumstats["_mWT"] >= 0
-  assert test_sumstats["_mWT"] == pytest.approx(expected_WT)
-
-
-
 def test_single_sample_sumstats():
   test_nchr = 1
   test_chr_end = [400]
@@ -601,16 +685,21 @@ def test_single_sample_sumstats():
 
 ### CALCULATE SUMMARY STATISTICS : ROH  ····························
 
-def roh(gv,pos,missing_threshold=3):
-  num_of_alt = gv.to_n_alt(fill=-1)
-  missing_sites = np.where(num_of_alt==-1)[0]
-  if missing_threshold > np.size(missing_sites) :
-    het_sites = np.where(num_of_alt==1)[0]
-    roh_limits = list(map(pos.__getitem__, list(het_sites)))
-    roh = np.diff(roh_limits)
-  else :
-    roh = np.array([])
-  return roh
+# individuals with this number of missing genotypes (or more) are excluded from RoH
+_ROH_MISSING_THRESHOLD = 3
+
+def _roh_lengths(n_alt, pos, missing_threshold):
+  # n_alt is the number of alternative alleles per variant (rows) and individual (columns), -1 for missing
+  # returns the distances between consecutive heterozygous sites of each included individual
+  num_of_alt = np.asarray(n_alt)
+  is_included = np.count_nonzero(num_of_alt==-1, axis=0) < missing_threshold
+  # heterozygous sites sorted by individual, then by position
+  het_ind, het_sites = np.nonzero((num_of_alt==1).T[is_included])
+  return np.diff(np.asarray(pos)[het_sites])[np.diff(het_ind)==0]
+
+def roh(n_alt,pos,missing_threshold=_ROH_MISSING_THRESHOLD):
+  # n_alt is the number of alternative alleles of one individual at each variant (-1 for missing)
+  return _roh_lengths(np.asarray(n_alt)[:,np.newaxis], pos, missing_threshold)
 
 def test_roh():
   # one individual, 11 loci
@@ -626,7 +715,7 @@ def test_roh():
                                  [[0,1]],
                                  [[0,1]]], dtype='i1')
   test_pos = (5,10,15,20,100,200,300,1300,3000,10000,20000)
-  test_roh = roh(test_ga,test_pos)
+  test_roh = roh(test_ga.to_n_alt(fill=-1)[:,0],test_pos)
   assert (test_roh == [5,10,80,200,1000,8700,10000]).all()
   test_ga = allel.GenotypeArray([[[ 0, 1]],
                                  [[ 0, 1]],
@@ -639,24 +728,25 @@ def test_roh():
                                  [[-1,-1]],
                                  [[ 0, 1]],
                                  [[ 0, 1]]], dtype='i1')
-  test_roh = roh(test_ga,test_pos)
+  test_n_alt = test_ga.to_n_alt(fill=-1)[:,0]
+  test_roh = roh(test_n_alt,test_pos)
   assert np.size(test_roh) == 0
-  test_roh = roh(test_ga,test_pos,4)
+  test_roh = roh(test_n_alt,test_pos,4)
   assert (test_roh == [5,90,200,9700,10000]).all()
 
 
-def distribution_roh(ga, pos, w_start, w_stop, number_of_bins):
+def distribution_roh(n_alt, pos, w_start, w_stop, number_of_bins, missing_threshold=_ROH_MISSING_THRESHOLD):
+  # n_alt is the number of alternative alleles per variant (rows) and individual (columns), -1 for missing
   # w_start and w_stop are the limits of the windows as positions in the genotype array, not positions in the genome
   if number_of_bins>1:
     roh_distribution = np.full(number_of_bins, 0)
   else:
     msg = "Negative value or zero. Number of bins has to be a positive integer"
     raise ValueError(msg)
-  for ind in range(0,ga.n_samples):
-    gv = ga[w_start:w_stop,ind]
-    roh_lenghts = roh(gv, pos[w_start:w_stop])
-    for roh_size in range(0,number_of_bins):
-      roh_distribution[roh_size] += sum( roh_lenghts >= 10**(roh_size) ) - sum( roh_lenghts >= 10**(roh_size+1) )
+  roh_lenghts = _roh_lengths(n_alt[w_start:w_stop], pos[w_start:w_stop], missing_threshold)
+  # bin k counts RoH of size in [10^k, 10^(k+1)), longer RoH are not counted
+  roh_bins = np.log10(roh_lenghts[roh_lenghts >= 1]).astype(np.int64)
+  roh_distribution += np.bincount(roh_bins, minlength=number_of_bins)[:number_of_bins]
   if (roh_distribution < 0).any():
     msg = "Negative value. Number of observations of RoH bin sizes has to be zero or higher"
     raise ValueError(msg)
@@ -681,11 +771,11 @@ def test_distribution_roh():
   test_start = 0
   test_end = 11
   number_of_bins = 5
-  d_roh = distribution_roh(test_ga, test_pos, test_start, test_end, number_of_bins)
+  d_roh = distribution_roh(test_ga.to_n_alt(fill=-1), test_pos, test_start, test_end, number_of_bins)
   assert (d_roh == [2,5,3,7,2]).all()
 
 
-def windowed_distribution_roh(ga, pos, size, start, stop):
+def windowed_distribution_roh(n_alt, pos, size, start, stop):
   # start and stop are the limts (in bp) of the genome whre the RoH are computed
   number_of_bins = int(round(np.log10(size)))+1
   roh_distribution = np.full(number_of_bins, 0)
@@ -694,7 +784,7 @@ def windowed_distribution_roh(ga, pos, size, start, stop):
     windows = allel.position_windows(pos, size=size, start=start, stop=stop, step=size)
     locs = allel.window_locations(pos, windows)
     for window_start, window_stop in locs :
-      roh_distribution = roh_distribution + distribution_roh(ga, pos, window_start, window_stop, number_of_bins)
+      roh_distribution = roh_distribution + distribution_roh(n_alt, pos, window_start, window_stop, number_of_bins)
   else:
     msg = "Wrong order. Vector of positions has to be monotonically increasing"
     raise ValueError(msg)
@@ -717,7 +807,7 @@ def test_windowed_distribution_roh():
   #            0   1   2   3    4    5    6     7     8      9     10
   test_pos = [ 5, 10, 15, 20, 100, 200, 300, 1300, 3000, 10000, 20000]
   test_size = 5000
-  d_roh = windowed_distribution_roh(test_ga, test_pos, test_size, 1, 20000)
+  d_roh = windowed_distribution_roh(test_ga.to_n_alt(fill=-1), test_pos, test_size, 1, 20000)
   assert (d_roh == [2,5,3,4,0]).all()
 
 ### CALCULATE SUMMARY STATISTICS : TWO SAMPLE  ····························
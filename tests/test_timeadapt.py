@@ -24,7 +24,10 @@ import allel
 import numpy as np
 import pandas as pd
 import math
+import msprime
+import os
 import pytest
+import tskit
 
 # TEST GET OPTIONS #############################################################################################
 
@@ -112,18 +115,15 @@ def test_get_options(temp_config_file,temp_sim_file,expected_result):
   assert options["sim"] == expected_result["sim"]
   assert type(options["verbose"]) is int
   assert options["verbose"] ==  expected_result["verbose"]
-  assert type(options["ss"]) is list
-  for i in options["ss"]:
-    assert type(i) is int
-  assert options["ss"] == expected_result["ss"]
-  assert type(options["chrono_order"]) is list
-  for i in options["chrono_order"]:
-    assert type(i) is int
-  assert options["chrono_order"] == expected_result["chrono_order"]
-  assert type(options["N"]) is list
-  for i in options["N"]:
-    assert type(i) is int
-  assert options["N"] == expected_result["N"]
+  assert type(options["ss"]) is np.ndarray
+  assert options["ss"].dtype == np.int64
+  assert list(options["ss"]) == expected_result["ss"]
+  assert type(options["chrono_order"]) is np.ndarray
+  assert options["chrono_order"].dtype == np.int64
+  assert list(options["chrono_order"]) == expected_result["chrono_order"]
+  assert type(options["N"]) is np.ndarray
+  assert options["N"].dtype == np.int64
+  assert list(options["N"]) == expected_result["N"]
   assert type(options["mu"]) is float
   assert options["mu"] == pytest.approx(expected_result["mu"])
   assert type(options["seed_coal"]) is int
@@ -132,6 +132,49 @@ def test_get_options(temp_config_file,temp_sim_file,expected_result):
   assert options["seed_mut"] == expected_result["seed_mut"]
   assert options["times_of_change_back"] == expected_result["times_of_change_back"]
   assert options["periods_coalescence"] == expected_result["periods_coalescence"]
+  # modifying the returned options does not modify the cached ini file
+  timeadapt._load_ini(temp_sim_file)["Demography"]["N"] = "1"
+  assert timeadapt._load_ini(temp_sim_file)["Demography"]["N"] != "1"
+
+test_bad_N = [pytest.param("N=1e+05 33 12\n", id="scientific"),
+              pytest.param("N=1.5 33 12\n", id="decimal"),
+              pytest.param("N=10 x 3\n", id="text")]
+@pytest.mark.parametrize("bad_N", test_bad_N)
+def test_get_sim_options_bad_N(bad_N):
+  with open(temp_sim_file_1) as f:
+    lines = [bad_N if line.startswith("N=") else line for line in f]
+  _, temp_bad_sim_file = tempfile.mkstemp()
+  with open(temp_bad_sim_file, 'w') as f:
+    f.writelines(lines)
+  with pytest.raises(ValueError):
+    timeadapt.get_sim_options(temp_bad_sim_file)
+
+test_bad_ini = [pytest.param("[Simulation]\nbatch=1\nsim 1\n", 3, id="no_equal_sign"),
+                pytest.param("batch=1\n[Simulation]\nsim=1\n", 1, id="no_section")]
+@pytest.mark.parametrize("ini_content,bad_line", test_bad_ini)
+def test_load_ini_bad_lines(ini_content,bad_line):
+  _, temp_bad_ini_file = tempfile.mkstemp()
+  with open(temp_bad_ini_file, 'w') as f:
+    f.write(ini_content)
+  with pytest.raises(ValueError, match="line "+str(bad_line)+" of "+temp_bad_ini_file):
+    timeadapt._load_ini(temp_bad_ini_file)
+
+def test_load_ini_reads_modified_file():
+  _, temp_ini_file = tempfile.mkstemp()
+  with open(temp_ini_file, 'w') as f:
+    f.write("[Simulation]\nsim=1\n")
+  assert timeadapt._load_ini(temp_ini_file)["Simulation"]["sim"] == "1"
+  with open(temp_ini_file, 'w') as f:
+    f.write("[Simulation]\nsim=2\n")
+  # force a different modification time (file systems may have a coarse time resolution)
+  mtime = os.path.getmtime(temp_ini_file) + 10
+  os.utime(temp_ini_file, (mtime, mtime))
+  assert timeadapt._load_ini(temp_ini_file)["Simulation"]["sim"] == "2"
+
+def test_load_ini_case_insensitive_keys():
+  ini = timeadapt._load_ini(temp_sim_file_1)
+  assert ini["Demography"]["n"] == ini["Demography"]["N"]
+  assert "SEED_MUT" in ini["Seeds"]
 
 # TEST GET TIMES OF CHANGE  ########################################################################################
 
@@ -162,6 +205,12 @@ result_sample_1 = {"id":["modern","ancient"],
                    "group_levels":1,
                    "groups":np.array([0,1])}
 
+_, temp_sample_file_bad_groups = tempfile.mkstemp()
+with open(temp_sample_file_bad_groups, 'w') as f:
+  f.write("sampleID age14C age14Cerror year coverage damageRepair groups\n")
+  f.write("modern   NA     NA          2010 30.03    TRUE         0\n")
+  f.write("ancient  1980   20          NA   10.01    TRUE         A\n")
+
 test_sample_files = [pytest.param(temp_sample_file_1, result_sample_1, id="1")]
 
 @pytest.mark.parametrize("sample_file,expected_result", test_sample_files)
@@ -181,6 +230,10 @@ def test_read_sample_info(sample_file,expected_result):
   assert sample_info["group_levels"] == expected_result["group_levels"]
   assert (sample_info["groups"] == expected_result["groups"]).all()
 
+def test_read_sample_info_bad_groups():
+  with pytest.raises(AssertionError):
+    timeadapt.read_sample_info(sample_info_file=temp_sample_file_bad_groups)
+
 # TEST READ GENOME INFO #############################################################################################
 
 _, temp_genome_file_1 = tempfile.mkstemp()
@@ -226,11 +279,11 @@ result_genome_1 = {"nchr":4,
                                               30000000,32999999,34999999,39999999]}}
 
 result_genome_2 = {"nchr":1,
-                   "chr_ends":1000000,
+                   "chr_ends":[1000000],
                    "msprime_r_map":{"rates":[1E-08,1E-07,1E-08],
-                                    "positions":[0, 1000000, 2000000,10000000]},
+                                    "positions":[0, 100000, 200000, 1000000]},
                    "slim_r_map":{"rates":[1E-08,1E-07,1E-08],
-                                 "positions":[999999, 1999999,9999999]}}
+                                 "positions":[99999, 199999, 999999]}}
 
 
 test_genome_files = [pytest.param(temp_genome_file_1, result_genome_1, id="1"),
@@ -239,12 +292,43 @@ test_genome_files = [pytest.param(temp_genome_file_1, result_genome_1, id="1"),
 @pytest.mark.parametrize("genome_file,expected_result", test_genome_files)
 def test_get_genome_info(genome_file,expected_result):
     genome_info = timeadapt.get_genome_info(genome_file)
-    assert genome_info["nchr"]==genome_info["nchr"]
-    assert genome_info["chr_ends"]==genome_info["chr_ends"]
-    assert genome_info["msprime_r_map"]["rates"]==genome_info["msprime_r_map"]["rates"]
-    assert genome_info["msprime_r_map"]["positions"]==genome_info["msprime_r_map"]["positions"]
-    assert genome_info["slim_r_map"]["rates"]==genome_info["slim_r_map"]["rates"]
-    assert genome_info["slim_r_map"]["positions"]==genome_info["slim_r_map"]["positions"]
+    assert genome_info["nchr"]==expected_result["nchr"]
+    assert genome_info["chr_ends"]==expected_result["chr_ends"]
+    assert genome_info["msprime_r_map"]["rates"]==pytest.approx(expected_result["msprime_r_map"]["rates"])
+    assert genome_info["msprime_r_map"]["positions"]==expected_result["msprime_r_map"]["positions"]
+    assert genome_info["slim_r_map"]["rates"]==pytest.approx(expected_result["slim_r_map"]["rates"])
+    assert genome_info["slim_r_map"]["positions"]==expected_result["slim_r_map"]["positions"]
+    # chromosome ends and recombination maps are lists
+    assert type(genome_info["chr_ends"]) is list
+    assert type(genome_info["msprime_r_map"]["positions"]) is list
+    assert type(genome_info["slim_r_map"]["rates"]) is list
+    # modifying the returned info does not modify the cached info
+    genome_info["msprime_r_map"]["rates"] = None
+    genome_info["slim_r_map"]["positions"] = None
+    genome_info = timeadapt.get_genome_info(genome_file)
+    assert genome_info["msprime_r_map"]["rates"] is not None
+    assert genome_info["slim_r_map"]["positions"] is not None
+
+### TEST GET SAMPLE AGES ###################################################################################
+
+def test_get_sample_ages():
+  # one modern and two ancient individuals, sampled in 2000 (t0)
+  test_sample = {"size":3,
+                 "ageBCAD":np.array([2000, np.nan, np.nan]),
+                 "t0":2000,
+                 "is_modern":np.array([True, False, False]),
+                 "is_ancient":np.array([False, True, True])}
+  # the age of the first ancient individual is certain, the second one has two possible ages
+  test_age_pdf = [pd.DataFrame({"ageBCAD":[-1000, -500, 0], "PrDens":[0, 1, 0]}),
+                  pd.DataFrame({"ageBCAD":[1000, 1500], "PrDens":[0.5, 0.5]})]
+  timeadapt.seed_rng(1234)
+  sample_ages = timeadapt.get_sample_ages(test_sample, test_age_pdf, gen_len=25)
+  assert all(type(age) is int for age in sample_ages)
+  assert sample_ages[:2] == [0, 100]
+  assert sample_ages[2] in (40, 20)
+  # same seed, same ages
+  timeadapt.seed_rng(1234)
+  assert timeadapt.get_sample_ages(test_sample, test_age_pdf, gen_len=25) == sample_ages
 
 ### TEST SAMPLE PARAMETER TRAJECTORY #######################################################################
 
@@ -257,7 +341,181 @@ def test_sample_param_trajectory(times,mininum,maximum):
   assert all(traj<=maximum)
   assert np.size(traj)==times
 
+### TEST SNP CALLING FROM SIMULATED READS : ALL LOCI AND INDIVIDUALS #######################################
+
+def test_snp_calling_batch():
+  timeadapt.seed_rng(1234)
+  test_genotypes = [[0, 1, 0, 0, 1, 1],
+                    [0, 1, 0, 0, 1, 1]]
+  test_num_reads = [[100, 100, 100],
+                    [  1, 100, 100]]
+  genotype_calls = timeadapt.snp_calling_batch(test_genotypes, test_num_reads, damage=[False, False, True],
+                                               transversion=[True, False], error_rate=0.005,
+                                               reads_th=1, score_th=10, ratio_th=3)
+  assert genotype_calls.dtype == np.int8
+  assert genotype_calls.shape == (2, 3, 2)
+  assert genotype_calls[0].tolist() == [[0,1],[0,0],[1,1]]
+  assert genotype_calls[1].tolist() == [[-1,-1],[0,0],[-1,-1]]
+
+### TEST SEQUENCING ########################################################################################
+
+def test_sequencing():
+  timeadapt.seed_rng(1234)
+  test_ts = msprime.sim_ancestry(samples=4, sequence_length=1e5, recombination_rate=1e-8,
+                                 population_size=1000, random_seed=1234)
+  test_ts = msprime.sim_mutations(test_ts, rate=1e-7, random_seed=1234)
+  assert test_ts.num_sites > 0
+  with pytest.raises(ValueError):
+    timeadapt.sequencing(test_ts, ssize=4, ttr=2, seq_error=0, damage=[False]*4, cov=[100]*3)
+  ga, positions = timeadapt.sequencing(test_ts, ssize=4, ttr=2, seq_error=0, damage=[False]*4, cov=[100]*4, block_size=7)
+  assert ga.shape == (test_ts.num_sites, 4, 2)
+  assert positions.dtype == np.int64
+  assert positions.tolist() == [round(site.position) for site in test_ts.sites()]
+  # with high coverage and no sequencing error, calls at biallelic sites are the true genotypes
+  for variant in test_ts.variants():
+    if len(variant.alleles) == 2:
+      assert ga[variant.site.id].tolist() == np.reshape(variant.genotypes, (4, 2)).tolist()
+    else:
+      assert (ga[variant.site.id] == -1).all()
+  # only the first 2*ssize sample nodes are sequenced
+  ga, positions = timeadapt.sequencing(test_ts, ssize=3, ttr=2, seq_error=0, damage=[False]*3, cov=[100]*3)
+  assert ga.shape == (test_ts.num_sites, 3, 2)
+  for variant in test_ts.variants():
+    if len(variant.alleles) == 2:
+      assert ga[variant.site.id].tolist() == np.reshape(variant.genotypes[:6], (3, 2)).tolist()
+
+def test_sequencing_multiple_mutations():
+  # 2 diploid individuals (sample nodes 0-3), tree ((0,1)4,(2,3)5)6
+  test_tables = tskit.TableCollection(sequence_length=100)
+  for time in [0, 0, 0, 0, 1, 1, 2]:
+    test_tables.nodes.add_row(flags=tskit.NODE_IS_SAMPLE if time == 0 else 0, time=time)
+  for parent, child in [(4, 0), (4, 1), (5, 2), (5, 3), (6, 4), (6, 5)]:
+    test_tables.edges.add_row(left=0, right=100, parent=parent, child=child)
+  # site 0: back mutation on node 0 (biallelic), site 1: A/G/T (triallelic), site 2: single mutation
+  test_tables.sites.add_row(position=10, ancestral_state="A")
+  test_tables.sites.add_row(position=20, ancestral_state="A")
+  test_tables.sites.add_row(position=30, ancestral_state="A")
+  test_tables.mutations.add_row(site=0, node=4, derived_state="G")
+  test_tables.mutations.add_row(site=0, node=0, derived_state="A", parent=0)
+  test_tables.mutations.add_row(site=1, node=4, derived_state="G")
+  test_tables.mutations.add_row(site=1, node=5, derived_state="T")
+  test_tables.mutations.add_row(site=2, node=2, derived_state="C")
+  test_ts = test_tables.tree_sequence()
+  timeadapt.seed_rng(1234)
+  ga, positions = timeadapt.sequencing(test_ts, ssize=2, ttr=2, seq_error=0, damage=[False]*2, cov=[100]*2)
+  assert positions.tolist() == [10, 20, 30]
+  assert ga[0].tolist() == [[0,1],[0,0]]
+  assert ga[1].tolist() == [[-1,-1],[-1,-1]]
+  assert ga[2].tolist() == [[0,0],[1,0]]
+
+### TEST DATA FOR SUMMARY STATISTICS #######################################################################
+
+#                                  ind 0   ind 1   ind 2   ind 3  
+test_ga_A = allel.GenotypeArray([[[ 0, 0],[ 0, 0],[ 0, 0],[ 0, 0]], # locus 0
+                                 [[ 0, 1],[ 0, 1],[ 0, 1],[ 1, 1]], # locus 1
+                                 [[-1,-1],[-1,-1],[-1,-1],[-1,-1]], # locus 2
+                                 [[ 1, 1],[ 1, 1],[ 0, 1],[ 1, 1]], # locus 3
+                                 [[ 0, 1],[ 0, 0],[ 0, 1],[ 0,-1]]],# locus 4
+                                 dtype='i1')
+#              0   1   2   3   4
+test_pos_A = (10,123,234,299,340)
+#                                  ind 0   ind 1   ind 2   ind 3  
+test_ga_B = allel.GenotypeArray([[[ 0, 1],[ 0, 1],[ 1, 1],[ 0, 0]], # locus 0
+                                 [[ 0, 1],[ 0, 1],[ 0, 1],[ 1, 1]], # locus 1
+                                 [[ 0, 1],[ 0, 1],[-1,-1],[ 1, 1]], # locus 2
+                                 [[ 0, 1],[ 0, 0],[ 0, 1],[ 1, 1]], # locus 3
+                                 [[ 0, 1],[ 0, 1],[ 0, 0],[ 1, 1]], # locus 4
+                                 [[ 0, 1],[ 0, 1],[ 0, 0],[ 1, 1]], # locus 5
+                                 [[ 1, 1],[ 0, 1],[ 0, 1],[ 1, 1]], # locus 6
+                                 [[ 0, 1],[ 0, 1],[ 0, 0],[ 1, 1]], # locus 7
+                                 [[ 1, 1],[ 0, 1],[ 0, 0],[ 0, 1]], # locus 8
+                                 [[ 0, 1],[ 0, 1],[ 0, 0],[ 1, 1]], # locus 9
+                                 [[ 1, 1],[ 0, 1],[ 0, 1],[ 1, 1]], # locus 10
+                                 [[ 0, 1],[ 0, 1],[ 0, 0],[ 1, 1]], # locus 11
+                                 [[ 0, 0],[ 0, 1],[ 0, 1],[ 0, 1]], # locus 12
+                                 [[-1,-1],[-1,-1],[-1,-1],[ 1, 1]], # locus 13
+                                 [[ 1, 1],[ 1, 1],[ 0, 0],[ 1, 1]], # locus 14
+                                 [[ 1, 1],[ 1, 1],[ 0, 0],[ 1, 1]], # locus 15
+                                 [[ 1, 1],[ 0, 1],[ 0, 0],[ 0, 1]], # locus 16
+                                 [[ 1, 1],[ 1, 1],[ 1, 0],[ 1, 1]], # locus 17
+                                 [[ 1, 1],[ 1, 1],[ 0, 0],[ 1, 1]], # locus 18
+                                 [[ 0, 1],[ 0, 0],[ 0, 1],[-1,-1]]],# locus 19
+                                 dtype='i1')
+#             0  1  2  3  4   5   6   7   8   9  10  11  12  13  14  15  16  17  18  19
+test_pos_B = (4,10,50,77,99,123,134,150,178,201,209,234,256,270,299,311,315,340,358,378)
+
+#                                 ga,        pos, nchr, chr_ends, w_size, expected_S
+testdata_S = [pytest.param(test_ga_A, test_pos_A,    1,    [400],     50,          3, id="A"),
+              pytest.param(test_ga_B, test_pos_B,    1,    [400],     50,         19, id="B")]
+#                                 ga,        pos, nchr, chr_ends, w_size, expected_Pi
+testdata_Pi = [pytest.param(test_ga_A, test_pos_A,    1,    [400],     50, 0.00315476, id="A"),
+               pytest.param(test_ga_B, test_pos_B,    1,    [400],     50, 0.02418452, id="B")]
+#                                 ga,        pos, nchr, chr_ends, w_size,  expected_WT
+testdata_WT = [pytest.param(test_ga_A, test_pos_A,    1,    [400],     50, 0.00289256, id="A"),
+               pytest.param(test_ga_B, test_pos_B,    1,    [400],     50, 0.01831956, id="B")]
+
+### TEST WINDOWED DIVERSITY ################################################################################
+
+#                                       ga,        pos, nchr,      chr_ends, w_size
+testdata_windows = [pytest.param(test_ga_A, test_pos_A,    1,         [400],     50, id="A"),
+                    pytest.param(test_ga_B, test_pos_B,    1,         [400],     50, id="B"),
+                    pytest.param(test_ga_B, test_pos_B,    2,     [200,400],     50, id="B_2chr"),
+                    pytest.param(test_ga_B, test_pos_B,    3, [100,250,400],     60, id="B_3chr")]
+
+@pytest.mark.parametrize("ga,pos,nchr,chr_ends,w_size", testdata_windows)
+def test_windowed_diversity_stats(ga,pos,nchr,chr_ends,w_size):
+  ac = ga.count_alleles()
+  w_pi, w_W_theta, w_Taj_D = timeadapt.windowed_diversity_stats(pos, ac, nchr, chr_ends, w_size)
+  # same as allel windowed statistics for each chromosome, one after the other
+  pos = np.asarray(pos)
+  expected_pi, expected_W_theta, expected_Taj_D = [], [], []
+  for chromo in range(0,nchr):
+    start = 1 if chromo == 0 else 1+chr_ends[chromo-1]
+    in_chr = (pos >= start) & (pos <= chr_ends[chromo])
+    chr_pi, _, _, _ = allel.windowed_diversity(pos[in_chr], ac[in_chr], size=w_size, start=start, stop=chr_ends[chromo])
+    chr_W_theta, _, _, _ = allel.windowed_watterson_theta(pos[in_chr], ac[in_chr], size=w_size, start=start, stop=chr_ends[chromo])
+    chr_Taj_D, _, _ = allel.windowed_tajima_d(pos[in_chr], ac[in_chr], size=w_size, start=start, stop=chr_ends[chromo])
+    expected_pi.extend(chr_pi)
+    expected_W_theta.extend(chr_W_theta)
+    expected_Taj_D.extend(chr_Taj_D)
+  assert list(w_pi) == pytest.approx(expected_pi)
+  assert list(w_W_theta) == pytest.approx(expected_W_theta)
+  assert list(w_Taj_D) == pytest.approx(expected_Taj_D, nan_ok=True)
+
+### TEST SINGLE SAMPLE SUMMARY STATISTICS ##################################################################
+
+@pytest.mark.parametrize("ga,pos,nchr,chr_ends,w_size,expected_S", testdata_S)
+def test_single_sample_sumstats_S(ga,pos,nchr,chr_ends,w_size,expected_S):
+  test_sumstats = {}
+  timeadapt.single_sample_sumstats(ga, pos, nchr, chr_ends, w_size, test_sumstats)
+  assert test_sumstats["_S"] == expected_S
+  assert test_sumstats["_S"] >= 0
 
+@pytest.mark.parametrize("ga,pos,nchr,chr_ends,w_size,expected_Pi", testdata_Pi)
+def test_single_sample_sumstats_Pi(ga,pos,nchr,chr_ends,w_size,expected_Pi):
+  test_sumstats = {}
+  timeadapt.single_sample_sumstats(ga, pos, nchr, chr_ends, w_size, test_sumstats)
+  assert test_sumstats["_Pi"] == pytest.approx(expected_Pi)
+  assert test_sumstats["_Pi"] >= 0
+  assert test_sumstats["_mPi"] == pytest.approx(expected_Pi)
 
+@pytest.mark.parametrize("ga,pos,nchr,chr_ends,w_size,expected_WT", testdata_WT)
+def test_single_sample_sumstats_WT(ga,pos,nchr,chr_ends,w_size,expected_WT):
+  test_sumstats = {}
+  timeadapt.single_sample_sumstats(ga, pos, nchr, chr_ends, w_size, test_sumstats)
+  assert test_sumstats["_mWT"] >= 0
+  assert test_sumstats["_mWT"] == pytest.approx(expected_WT)
 
+# RoH are counted in windows of every chromosome (windows do not span chromosome ends)
+#                                 ga,        pos, nchr,      chr_ends, w_size, expected_RoHD
+testdata_RoHD = [pytest.param(test_ga_B, test_pos_B,    1,         [400],    390,   [3,25,1,0], id="B"),
+                 pytest.param(test_ga_B, test_pos_B,    2,     [200,400],    390,   [3,21,1,0], id="B_2chr"),
+                 pytest.param(test_ga_B, test_pos_B,    2,     [130,400],    390,   [3,22,1,0], id="B_2chr_uneven"),
+                 pytest.param(test_ga_B, test_pos_B,    3, [130,250,400],    100,     [3,14,0], id="B_3chr")]
 
+@pytest.mark.parametrize("ga,pos,nchr,chr_ends,w_size,expected_RoHD", testdata_RoHD)
+def test_single_sample_sumstats_RoHD(ga,pos,nchr,chr_ends,w_size,expected_RoHD):
+  test_sumstats = {}
+  timeadapt.single_sample_sumstats(ga, pos, nchr, chr_ends, w_size, test_sumstats)
+  assert [test_sumstats["_RoHD_"+str(i)] for i in range(len(expected_RoHD))] == expected_RoHD
+  assert "_RoHD_"+str(len(expected_RoHD)) not in test_sumstats